@@ -1,25 +1,26 @@
 import streamlit as st
 import ee
 import datetime
+import gzip
 import logging
-import csv
 import json
-from io import StringIO
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import folium
 from streamlit_folium import st_folium
 import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
-# Initialize Earth Engine using service account credentials from st.secrets
-try:
+# Parse the service account credentials from st.secrets once per process
+@st.cache_resource
+def load_credentials():
     # Get Earth Engine credentials dict from secrets.toml
     credentials_dict = st.secrets["earthengine"]
-    logger.debug(f"Raw credentials: {credentials_dict}")
     
     # Handle case where credentials_dict is a string or nested
     if isinstance(credentials_dict, str):
@@ -37,16 +38,268 @@ try:
     
     # Convert credentials_dict to JSON string for key_data
     credentials_json = json.dumps(credentials_dict)
-    logger.debug(f"Credentials JSON: {credentials_json}")
     
-    # Initialize EE with ServiceAccountCredentials
+    # Build ServiceAccountCredentials (parses the private key)
     service_account = credentials_dict["client_email"]
-    credentials = ee.ServiceAccountCredentials(service_account, key_data=credentials_json)
-    ee.Initialize(credentials)
+    return ee.ServiceAccountCredentials(service_account, key_data=credentials_json)
+
+
+# Initialize Earth Engine once per process; a failed attempt is retried on the next rerun
+@st.cache_resource
+def init_earth_engine():
+    ee.Initialize(load_credentials())
     logger.info("Earth Engine initialized successfully.")
+    return True
+
+
+try:
+    init_earth_engine()
 except Exception as e:
     st.error(f"Earth Engine initialization failed: {e}")
-    logger.error(f"Earth Engine initialization failed: {e}")
+    logger.error("Earth Engine initialization failed: %s", e)
+
+
+# Axis labels and formats for each aggregation granularity
+GRANULARITIES = {
+    'monthly': {'period': 'Month', 'date_format': '%Y-%m', 'precip_unit': 'mm/month'},
+    'daily': {'period': 'Date', 'date_format': '%Y-%m-%d', 'precip_unit': 'mm/day'},
+}
+
+# CSV downloads with more rows than this are gzip-compressed
+GZIP_CSV_ROWS = 10000
+
+
+# Filter the NEX-GDDP-CMIP6 collection to a point, date range, model and scenario
+def get_dataset(point, start_date, end_date, model, scenario):
+    return ee.ImageCollection('NASA/GDDP-CMIP6') \
+        .filterDate(str(start_date), str(end_date)) \
+        .filter(ee.Filter.eq('model', model)) \
+        .filter(ee.Filter.eq('scenario', scenario)) \
+        .filterBounds(point) \
+        .select(['pr', 'tasmin', 'tasmax'])
+
+
+# Fetch daily climate values for a point; identical requests are served from the cache
+@st.cache_data(ttl=3600, show_spinner="Fetching climate data...")
+def fetch_daily_climate(lat, lon, start_date, end_date, model, scenario):
+    point = ee.Geometry.Point([lon, lat])
+    dataset = get_dataset(point, start_date, end_date, model, scenario)
+
+    # Sample the daily images at the point one year per request
+    def fetch_year(year):
+        year_start = max(start_date, datetime.date(year, 1, 1))
+        year_end = min(end_date, datetime.date(year + 1, 1, 1))
+        return dataset.filterDate(str(year_start), str(year_end)) \
+            .getRegion(point, 25000).getInfo()  # NEX-GDDP resolution (~25 km)
+
+    # Yearly requests are independent, so issue them concurrently
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        # End date is exclusive, so the last chunk is the year of the day before it
+        last_year = (end_date - datetime.timedelta(days=1)).year
+        regions = list(executor.map(fetch_year, range(start_date.year, last_year + 1)))
+
+    # Empty chunks only carry the id/longitude/latitude/time header, so take the band layout from one with data
+    regions = [region for region in regions if len(region) > 1]
+    if not regions:
+        return pd.DataFrame(
+            columns=['precipitation_mm', 'min_temperature_c', 'max_temperature_c'],
+            index=pd.DatetimeIndex([], name='date'),
+            dtype=float
+        )
+    header = regions[0][0]
+    values = np.asarray([row for region in regions for row in region[1:]], dtype=object) \
+        .reshape(-1, len(header))
+
+    # Convert units for the whole series at once
+    dates = pd.to_datetime(values[:, header.index('time')].astype(np.int64), unit='ms')
+    precip_mm = values[:, header.index('pr')].astype(float) * 86400  # Convert kg/m^2/s to mm/day
+    tasmin_c = values[:, header.index('tasmin')].astype(float) - 273.15
+    tasmax_c = values[:, header.index('tasmax')].astype(float) - 273.15
+
+    return pd.DataFrame({
+        'precipitation_mm': precip_mm,
+        'min_temperature_c': tasmin_c,
+        'max_temperature_c': tasmax_c
+    }, index=pd.DatetimeIndex(dates, name='date')).dropna()
+
+
+# Fetch monthly climate statistics for a point; identical requests are served from the cache
+@st.cache_data(ttl=3600, show_spinner="Fetching climate data...")
+def fetch_monthly_climate(lat, lon, start_date, end_date, model, scenario):
+    point = ee.Geometry.Point([lon, lat])
+    dataset = get_dataset(point, start_date, end_date, model, scenario)
+
+    # Month starts covering the requested range (end date is exclusive)
+    months = pd.date_range(
+        start_date.replace(day=1), end_date - datetime.timedelta(days=1), freq='MS'
+    ).strftime('%Y-%m-%d').tolist()
+
+    # Aggregate each month on the server and sample it at the point
+    def aggregate_month(month):
+        month = ee.Date(month)
+        monthly_dataset = dataset.filterDate(month, month.advance(1, 'month'))
+        # Total precipitation and mean temperatures; no other bands are reduced
+        stats = monthly_dataset.select('pr').sum() \
+            .addBands(monthly_dataset.select(['tasmin', 'tasmax']).mean()) \
+            .reduceRegion(
+                reducer=ee.Reducer.first(),
+                geometry=point,
+                scale=25000  # NEX-GDDP resolution (~25 km)
+            )
+        return ee.Feature(None, stats).set('date', month.format('YYYY-MM'))
+
+    # Fetch all months in a single request
+    features = ee.FeatureCollection(ee.List(months).map(aggregate_month)).getInfo()['features']
+    properties = [feature['properties'] for feature in features]
+
+    # Convert units for the whole series at once
+    dates = pd.to_datetime([p['date'] for p in properties], format='%Y-%m')
+    precip_sum = np.array([p.get('pr') for p in properties], dtype=float)
+    tasmin_mean = np.array([p.get('tasmin') for p in properties], dtype=float)
+    tasmax_mean = np.array([p.get('tasmax') for p in properties], dtype=float)
+
+    df = pd.DataFrame({
+        'precipitation_mm': precip_sum * 86400,  # Convert to mm/month
+        'min_temperature_c': tasmin_mean - 273.15,
+        'max_temperature_c': tasmax_mean - 273.15
+    }, index=pd.DatetimeIndex(dates, name='date')).dropna()
+
+    # Calculate flood and drought risks
+    df['flood_risk'] = pd.cut(
+        df['precipitation_mm'],
+        bins=[-np.inf, 50, 100, np.inf],
+        labels=['Low', 'Moderate', 'High']
+    )
+    df['drought_risk'] = np.select(
+        [
+            (df['precipitation_mm'] < 30) & (df['max_temperature_c'] > 30),
+            (df['precipitation_mm'] < 50) & (df['max_temperature_c'] > 25)
+        ],
+        ['High', 'Moderate'],
+        default='Low'
+    )
+
+    return df
+
+
+# Map with a click-to-place marker for selecting the location; built once per process and shared read-only
+@st.cache_resource
+def build_map():
+    m = folium.Map(location=[0, 0], zoom_start=2)
+    m.add_child(folium.ClickForMarker(popup="Selected Location"))
+    return m
+
+
+# Create one Plotly figure with precipitation and temperature panels for the fetched data
+def build_figure(df, granularity):
+    label = granularity.capitalize()
+    period = GRANULARITIES[granularity]['period']
+    precip_unit = GRANULARITIES[granularity]['precip_unit']
+    date_format = GRANULARITIES[granularity]['date_format']
+
+    # NumPy arrays keep Plotly validation and the chart payload small
+    x = df.index.values.astype('datetime64[D]')
+    precip = df['precipitation_mm'].to_numpy(dtype=np.float32)
+    tasmin = df['min_temperature_c'].to_numpy(dtype=np.float32)
+    tasmax = df['max_temperature_c'].to_numpy(dtype=np.float32)
+
+    fig = make_subplots(
+        rows=3,
+        cols=1,
+        shared_xaxes=True,
+        vertical_spacing=0.08,
+        subplot_titles=[
+            f"{label} Precipitation",
+            f"{label} Minimum Temperature",
+            f"{label} Maximum Temperature"
+        ]
+    )
+    if granularity == 'monthly':
+        fig.add_trace(go.Bar(
+            x=x,
+            y=precip,
+            name=f'{label} Precipitation'
+        ), row=1, col=1)
+    else:
+        fig.add_trace(go.Scattergl(
+            x=x,
+            y=precip,
+            mode='lines',
+            name=f'{label} Precipitation'
+        ), row=1, col=1)
+    fig.add_trace(go.Scattergl(
+        x=x,
+        y=tasmin,
+        mode='lines+markers',
+        name='Min Temperature'
+    ), row=2, col=1)
+    fig.add_trace(go.Scattergl(
+        x=x,
+        y=tasmax,
+        mode='lines+markers',
+        name='Max Temperature'
+    ), row=3, col=1)
+
+    fig.update_xaxes(hoverformat=date_format)
+    fig.update_xaxes(title_text=period, row=3, col=1)
+    fig.update_yaxes(title_text=f"Precipitation ({precip_unit})", row=1, col=1)
+    fig.update_yaxes(title_text="Temperature (°C)", row=2, col=1)
+    fig.update_yaxes(title_text="Temperature (°C)", row=3, col=1)
+    fig.update_layout(
+        title=f"{label} Climate (Future Projection)",
+        height=900,
+        showlegend=False,
+        template="plotly_white"
+    )
+
+    return fig
+
+
+# Offer the fetched data as a CSV download
+def download_csv(df, granularity):
+    csv_bytes = df.reset_index().to_csv(index=False).encode('utf-8')
+    file_name = f"{granularity}_climate_projections.csv"
+    mime = "text/csv"
+    if len(df) > GZIP_CSV_ROWS:
+        csv_bytes = gzip.compress(csv_bytes)
+        file_name += ".gz"
+        mime = "application/gzip"
+
+    st.download_button(
+        label=f"Download {granularity.capitalize()} CSV",
+        data=csv_bytes,
+        file_name=file_name,
+        mime=mime
+    )
+
+
+# Map and selected coordinates; map clicks rerun only this fragment
+@st.fragment
+def location_picker():
+    map_data = st_folium(build_map(), width=500, height=400, returned_objects=["last_clicked"], key="mainmap")
+    if map_data.get("last_clicked"):
+        lat = map_data["last_clicked"]["lat"]
+        lon = map_data["last_clicked"]["lng"]
+        st.session_state['location'] = (lat, lon)
+        st.write(f"Selected: Lat {lat:.4f}, Lon {lon:.4f}")
+
+
+# Plots, table and download for the last fetch; interactions rerun only this fragment
+@st.fragment
+def results_panel():
+    df = st.session_state['df']
+    granularity = st.session_state['granularity']
+    st.plotly_chart(st.session_state['fig'])
+
+    # Display data (with risks for monthly aggregates)
+    if granularity == 'monthly':
+        st.subheader("Monthly Climate Data and Risk Assessment")
+    else:
+        st.subheader("Daily Climate Data")
+    st.dataframe(df)
+
+    download_csv(df, granularity)
+
 
 # Streamlit app layout
 st.title("NEX-GDDP-CMIP6 Future Climate Projections Explorer")
@@ -57,11 +310,9 @@ col1, col2 = st.columns([3, 1])
 
 # Map for selecting location in first column
 with col1:
-    m = folium.Map(location=[0, 0], zoom_start=2)
-    m.add_child(folium.ClickForMarker(popup="Selected Location"))
-    map_data = st_folium(m, width=500, height=400)
+    location_picker()
 
-# Date inputs, model, and scenario in second column
+# Date inputs, model, scenario and granularity in second column
 with col2:
     st.subheader("Future Date Range")
     min_date = datetime.date(2025, 1, 1)
@@ -74,17 +325,11 @@ with col2:
     scenarios = ['ssp245', 'ssp585']  # Future scenarios only
     selected_model = st.selectbox("Select Model", models, index=0)
     selected_scenario = st.selectbox("Select Scenario", scenarios, index=0)
-    
-    # Display selected coordinates
-    lat = None
-    lon = None
-    if map_data.get("last_clicked"):
-        lat = map_data["last_clicked"]["lat"]
-        lon = map_data["last_clicked"]["lng"]
-        st.write(f"Selected: Lat {lat:.4f}, Lon {lon:.4f}")
+    granularity = st.radio("Granularity", list(GRANULARITIES), format_func=str.capitalize)
 
 # Button to fetch data
 if st.button("Fetch Climate Data"):
+    lat, lon = st.session_state.get('location', (None, None))
     if lat is None or lon is None:
         st.error("Please click a location on the map.")
     elif start_date >= end_date:
@@ -94,154 +339,27 @@ if st.button("Fetch Climate Data"):
     elif end_date > datetime.date(2100, 12, 31):
         st.error("End date cannot be after 2100.")
     else:
+        # Drop results from a previous fetch so they are not shown for the new inputs
+        st.session_state.pop('df', None)
         try:
-            point = ee.Geometry.Point([lon, lat])
-            dataset = ee.ImageCollection('NASA/GDDP-CMIP6') \
-                .filterDate(str(start_date), str(end_date)) \
-                .filter(ee.Filter.eq('model', selected_model)) \
-                .filter(ee.Filter.eq('scenario', selected_scenario)) \
-                .filterBounds(point)
-
-            # Define a function to aggregate daily data to monthly
-            def aggregate_monthly(image):
-                date = ee.Date(image.get('system:time_start'))
-                year_month = date.format('YYYY-MM')
-                precip_sum = image.select('pr').multiply(86400)  # Convert kg/m^2/s to mm/day and sum
-                tasmin_mean = image.select('tasmin').subtract(273.15)  # Convert to Celsius
-                tasmax_mean = image.select('tasmax').subtract(273.15)  # Convert to Celsius
-                return ee.Image(image).set({
-                    'year_month': year_month,
-                    'precip_sum': precip_sum,
-                    'tasmin_mean': tasmin_mean,
-                    'tasmax_mean': tasmax_mean
-                })
-
-            # Aggregate to monthly data
-            monthly_collection = dataset.map(aggregate_monthly).aggregate_array('year_month').distinct()
-            monthly_data_list = []
-            
-            for year_month in monthly_collection.getInfo():
-                month_start = datetime.datetime.strptime(year_month, '%Y-%m')
-                month_end = (month_start + datetime.timedelta(days=31)).replace(day=1) - datetime.timedelta(days=1)
-                
-                monthly_dataset = dataset.filterDate(
-                    ee.Date(year_month + '-01'),
-                    ee.Date(month_end.strftime('%Y-%m-%d')).advance(1, 'day')
-                )
-                
-                # Aggregate for the month
-                monthly_stats = monthly_dataset.reduce(ee.Reducer.sum().combine(
-                    reducer2=ee.Reducer.mean(),
-                    sharedInputs=True
-                ))
-                
-                data = monthly_stats.reduceRegion(
-                    reducer=ee.Reducer.first(),
-                    geometry=point,
-                    scale=25000  # NEX-GDDP resolution (~25 km)
-                ).getInfo()
-                
-                precip_sum = data.get('pr_sum')
-                tasmin_mean = data.get('tasmin_mean')
-                tasmax_mean = data.get('tasmax_mean')
-                
-                if all(v is not None for v in [precip_sum, tasmin_mean, tasmax_mean]):
-                    precip_mm = float(precip_sum) * 86400  # Convert to mm/month
-                    tasmin_c = float(tasmin_mean) - 273.15
-                    tasmax_c = float(tasmax_mean) - 273.15
-                    
-                    monthly_data_list.append({
-                        'date': year_month,
-                        'precipitation_mm': precip_mm,
-                        'min_temperature_c': tasmin_c,
-                        'max_temperature_c': tasmax_c
-                    })
-
-            if monthly_data_list:
-                # Convert to DataFrame
-                df = pd.DataFrame(monthly_data_list)
-                df['date'] = pd.to_datetime(df['date'])
-                df.set_index('date', inplace=True)
-
-                # Calculate flood and drought risks
-                df['flood_risk'] = df['precipitation_mm'].apply(
-                    lambda x: 'High' if x > 100 else 'Moderate' if x > 50 else 'Low'
-                )
-                df['drought_risk'] = df.apply(
-                    lambda row: 'High' if (row['precipitation_mm'] < 30 and row['max_temperature_c'] > 30) 
-                    else 'Moderate' if (row['precipitation_mm'] < 50 and row['max_temperature_c'] > 25) 
-                    else 'Low', axis=1
-                )
-
-                # Create Plotly figures for monthly data
-                fig_precip = go.Figure()
-                fig_precip.add_trace(go.Bar(
-                    x=df.index.strftime('%Y-%m'),
-                    y=df['precipitation_mm'],
-                    name='Monthly Precipitation'
-                ))
-                fig_precip.update_layout(
-                    title="Monthly Precipitation (Future Projection)",
-                    xaxis_title="Month",
-                    yaxis_title="Precipitation (mm/month)",
-                    template="plotly_white"
-                )
-
-                fig_tasmin = go.Figure()
-                fig_tasmin.add_trace(go.Scatter(
-                    x=df.index.strftime('%Y-%m'),
-                    y=df['min_temperature_c'],
-                    mode='lines+markers',
-                    name='Min Temperature'
-                ))
-                fig_tasmin.update_layout(
-                    title="Monthly Minimum Temperature (Future Projection)",
-                    xaxis_title="Month",
-                    yaxis_title="Temperature (°C)",
-                    template="plotly_white"
-                )
-
-                fig_tasmax = go.Figure()
-                fig_tasmax.add_trace(go.Scatter(
-                    x=df.index.strftime('%Y-%m'),
-                    y=df['max_temperature_c'],
-                    mode='lines+markers',
-                    name='Max Temperature'
-                ))
-                fig_tasmax.update_layout(
-                    title="Monthly Maximum Temperature (Future Projection)",
-                    xaxis_title="Month",
-                    yaxis_title="Temperature (°C)",
-                    template="plotly_white"
-                )
-
-                # Display plots
-                st.plotly_chart(fig_precip)
-                st.plotly_chart(fig_tasmin)
-                st.plotly_chart(fig_tasmax)
-
-                # Display monthly data with risks
-                st.subheader("Monthly Climate Data and Risk Assessment")
-                st.dataframe(df)
-
-                # Generate CSV for download
-                output = StringIO()
-                df.reset_index().to_csv(output, index=False)
-                csv_string = output.getvalue()
-                output.close()
-
-                st.download_button(
-                    label="Download Monthly CSV",
-                    data=csv_string,
-                    file_name="monthly_climate_projections.csv",
-                    mime="text/csv"
-                )
-                logger.info(f"Displayed data: {len(df)} months")
+            fetch_climate = fetch_monthly_climate if granularity == 'monthly' else fetch_daily_climate
+            df = fetch_climate(lat, lon, start_date, end_date, selected_model, selected_scenario)
+
+            if not df.empty:
+                # Build the figure once per fetch rather than on every rerun
+                st.session_state['fig'] = build_figure(df, granularity)
+                st.session_state['df'] = df
+                st.session_state['granularity'] = granularity
+                logger.info("Fetched data: %d %s rows", len(df), granularity)
             else:
                 st.error("No data available for the selected location, date range, model, or scenario.")
         except Exception as e:
             st.error(f"Failed to fetch data: {str(e)}")
-            logger.error(f"Unexpected error: {e}")
+            logger.error("Unexpected error: %s", e)
+
+# Results persist across reruns until the next fetch
+if 'df' in st.session_state:
+    results_panel()
 
 if __name__ == "__main__":
     st.write("Streamlit app running")